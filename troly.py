@@ -1,18 +1,27 @@
 # -*- coding: utf-8 -*-
 import os
-import re
 import time
 import json
+import queue
 import logging
 import threading
 import signal
+import atexit
+import functools
+import heapq
+import shutil
+import collections
+import contextlib
+import hmac
+import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, Optional, List, Tuple
+from typing import Any, Callable, Dict, Optional, List, Tuple
+from urllib.parse import urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-import requests
-from requests.adapters import HTTPAdapter
+import urllib3
 from urllib3.util.retry import Retry
-from flask import Flask
 
 # ==========================================================
 # CONFIG
@@ -36,6 +45,15 @@ def get_render_url() -> Optional[str]:
 
 RENDER_EXTERNAL_URL = get_render_url()
 
+# Webhook mode (opt-in): with WEBHOOK_SECRET set and a public URL, Telegram
+# pushes updates to /webhook/<secret> and the long poll is not started.
+# The secret doubles as setWebhook's secret_token, so keep it to A-Z a-z 0-9 _ -.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_MAX_BODY = 1 << 20
+USE_WEBHOOK = bool(WEBHOOK_SECRET and RENDER_EXTERNAL_URL)
+
 # Timezone VN
 try:
     from zoneinfo import ZoneInfo
@@ -47,21 +65,46 @@ def now_vn() -> datetime:
     return datetime.now(VN_TZ)
 
 def fmt_dt() -> str:
-    return now_vn().strftime("%H:%M • %d/%m/%Y")
+    n = now_vn()
+    return f"{n.hour:02d}:{n.minute:02d} • {n.day:02d}/{n.month:02d}/{n.year}"
 
 def fmt_time() -> str:
-    return now_vn().strftime("%H:%M")
+    n = now_vn()
+    return f"{n.hour:02d}:{n.minute:02d}"
 
 # Telegram
 TG_CONNECT_TIMEOUT = 10
 TG_READ_TIMEOUT = 35
 UPDATES_LONGPOLL = 35
+UPDATES_LIMIT = 100
+UPDATES_BACKOFF_MIN = 2.0
+UPDATES_BACKOFF_MAX = 30.0
+# Per-chat token bucket for incoming updates, and the longest text handled
+CHAT_RATE_PER_SEC = 2.0
+CHAT_RATE_BURST = 10.0
+RATE_LOG_WINDOW_SEC = 60.0  # at most one "rate limited" log line per chat per window
+SEEN_UPDATES_MAX = 4096  # recent update_ids remembered to drop redeliveries
+MAX_TEXT_LEN = 256
+UPDATE_WORKERS = min(32, (os.cpu_count() or 1) * 5)
+ANSWER_WORKERS = 4  # answerCallbackQuery runs beside the handler, not before it
+
+# Outbound send queue (scheduler broadcasts)
+SEND_WORKERS = 5
+SEND_QUEUE_MAX = 10000
+SEND_RATE_PER_SEC = 30  # Telegram global limit ~30 msg/s
 
 # Scheduler
-SCHED_TICK = 20
+SCHED_MIN_DELAY_SEC = 1.0
 
 # Files
-USERS_FILE = "assistant_users.json"
+USERS_DIR = "assistant_users"  # one <chat_id>.json per user
+USERS_FILE = "assistant_users.json"  # legacy single file, migrated into USERS_DIR once
+USERS_SAVE_DEBOUNCE_SEC = 2.0  # collect changes this long before a flush
+OFFSET_FILE = "assistant_offset.json"  # last update_id handed to the workers
+# Telegram restarts update_ids at random after a week without updates (and ids
+# differ per bot), so an older or foreign saved offset could swallow every update
+OFFSET_MAX_AGE_SEC = 24 * 3600
+OFFSET_SAVE_INTERVAL_SEC = 1.0
 
 # ==========================================================
 # LOGGING
@@ -78,6 +121,8 @@ log = logging.getLogger("ASSISTANT_BOT")
 # GLOBALS
 # ==========================================================
 shutdown_event = threading.Event()
+# Set to wake the scheduler early (schedule changed or shutting down)
+sched_wakeup = threading.Event()
 
 # ==========================================================
 # HOLIDAYS (SOLAR / LUNAR - mapping to SOLAR dates by year)
@@ -112,163 +157,492 @@ LUNAR_HOLIDAYS_2025: Dict[str, str] = {
     "11-29": "🍲 Tết Ông Công Ông Táo (23/12 ÂL)",
 }
 
+# Single lookup table; solar is applied last so it wins on shared days (e.g. 02-14)
+_ALL_HOLIDAYS: Dict[str, str] = {}
+_ALL_HOLIDAYS.update(LUNAR_HOLIDAYS_2025)
+_ALL_HOLIDAYS.update(SOLAR_HOLIDAYS)
+
 def check_holiday(mm_dd: str) -> Optional[str]:
     """Check if date is a holiday (MM-DD format)."""
-    if mm_dd in SOLAR_HOLIDAYS:
-        return SOLAR_HOLIDAYS[mm_dd]
-    if mm_dd in LUNAR_HOLIDAYS_2025:
-        return LUNAR_HOLIDAYS_2025[mm_dd]
-    return None
+    return _ALL_HOLIDAYS.get(mm_dd)
 
 # ==========================================================
 # SELF-PING KEEPER
 # ==========================================================
 class SelfPingKeeper:
-    def __init__(self, session: requests.Session):
-        self.session = session
+    """Pings our own /ping on a timer; driven by scheduler_loop, no thread of its own."""
+
+    def __init__(self):
         self.url = (RENDER_EXTERNAL_URL.rstrip("/") + "/ping") if RENDER_EXTERNAL_URL else None
         self.ping_count = 0
+        self.next_at = 0.0  # time.monotonic() of the next ping
+
+    def delay(self) -> Optional[float]:
+        """Seconds until the next ping is due, or None when disabled."""
+        if not self.url:
+            return None
+        return self.next_at - time.monotonic()
+
+    def maybe_ping(self):
+        """Hand the ping to the worker pool if due, so the scheduler never blocks on it."""
+        if not self.url or time.monotonic() < self.next_at:
+            return
+        self.next_at = time.monotonic() + SELF_PING_INTERVAL_SEC
+        EXECUTOR.submit(self.ping_self)
 
     def ping_self(self):
         if not self.url:
             return
         try:
-            r = self.session.get(self.url, timeout=10)
-            if r.status_code == 200:
+            # Shared pool, no retries: the next ping is only minutes away
+            r = HTTP.request("GET", self.url, headers=_PING_HEADERS, timeout=10.0, retries=False)
+            if r.status == 200:
                 self.ping_count += 1
                 log.info("🏓 Self-ping OK (#%d)", self.ping_count)
             else:
-                log.warning("⚠️ Self-ping HTTP %s", r.status_code)
+                log.warning("⚠️ Self-ping HTTP %s", r.status)
         except Exception as e:
             log.warning("⚠️ Self-ping error: %s", e)
 
-def run_self_pinger():
-    if not RENDER_EXTERNAL_URL:
-        log.warning("⚠️ Self-ping disabled (no RENDER_EXTERNAL_URL/RENDER_SERVICE_NAME)")
-        return
-
-    session = requests.Session()
-    session.headers.update({"User-Agent": "Assistant-Ping/1.0"})
-    keeper = SelfPingKeeper(session)
-
-    log.info("🏓 Self-ping started: %s", RENDER_EXTERNAL_URL)
-
-    while not shutdown_event.is_set():
-        try:
-            keeper.ping_self()
-        except Exception as e:
-            log.warning("⚠️ Self-ping loop error: %s", e)
-        time.sleep(SELF_PING_INTERVAL_SEC)
+SELF_PING = SelfPingKeeper()
 
 # ==========================================================
 # HTTP SESSION
 # ==========================================================
-def make_session() -> requests.Session:
-    s = requests.Session()
+# Enough kept-alive connections for every thread that can call Telegram at once
+# (update workers + senders + callback answers + self-ping), so none is opened and thrown away
+HTTP_POOL_MAXSIZE = UPDATE_WORKERS + SEND_WORKERS + ANSWER_WORKERS + 1
+
+def make_session(maxsize: int = HTTP_POOL_MAXSIZE,
+                 retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)) -> urllib3.PoolManager:
+    """Raw urllib3 pool for Telegram calls (skips requests' per-call overhead)."""
     retry = Retry(
         total=3,
         connect=3,
         read=3,
-        backoff_factor=0.5,
-        status_forcelist=(429, 500, 502, 503, 504),
+        backoff_factor=0.2,
+        status_forcelist=retry_statuses,
+        # urllib3 retries any 429/503 carrying Retry-After regardless of the
+        # forcelist, so leaving 429 out must switch that off too
+        respect_retry_after_header=429 in retry_statuses,
         allowed_methods=("GET", "POST"),
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    s.mount("http://", adapter)
-    s.mount("https://", adapter)
-    s.headers.update({"User-Agent": "Mozilla/5.0"})
-    return s
+    return urllib3.PoolManager(
+        num_pools=4,
+        maxsize=maxsize,
+        block=False,
+        retries=retry,
+        headers={
+            "User-Agent": "Mozilla/5.0",
+            "Connection": "keep-alive",
+            "Accept-Encoding": "gzip",
+        },
+    )
 
 HTTP = make_session()
+_PING_HEADERS = {**HTTP.headers, "User-Agent": "Assistant-Ping/1.0"}
+# The long poll gets its own single kept-alive connection so it never waits
+# behind (or evicts) the connections used by concurrent sends. 429 is not retried
+# here: handle_updates_forever waits out retry_after itself, exactly once.
+POLL_HTTP = make_session(maxsize=1, retry_statuses=(500, 502, 503, 504))
 
 # ==========================================================
 # STORAGE
 # ==========================================================
+# JSON codec: orjson when installed (faster, emits UTF-8 bytes), stdlib otherwise
+try:
+    import orjson
+
+    def json_dumps_bytes(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+    def json_dumps_compact(data: Any) -> bytes:
+        return orjson.dumps(data)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps_bytes(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    def json_dumps_compact(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
 _io_lock = threading.Lock()
+_write_lock = threading.Lock()  # serializes file writes (held without _io_lock)
+
+# In-memory users store (loaded once, written to disk by run_users_writer)
+_USERS_CACHE: Optional[Dict[str, Any]] = None
+_DIRTY_CIDS: set = set()  # chat ids changed since the last flush; guarded by _io_lock
+_USERS_SHARDED = False  # False until USERS_DIR is complete; flushes then go to USERS_FILE
+# Pending-save signal; maxsize=1 coalesces bursts of set_users() into one write
+_save_queue: "queue.Queue[bool]" = queue.Queue(maxsize=1)
 
 def load_json(path: str, default: Any) -> Any:
     try:
         if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return json_loads(f.read())
     except Exception:
         pass
     return default
 
-def save_json(path: str, data: Any):
+def write_bytes_atomic(path: str, blob: bytes):
     try:
         tmp = path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(tmp, "wb") as f:
+            f.write(blob)
         os.replace(tmp, path)
     except Exception as e:
         log.error("Save error: %s", e)
 
+def save_json(path: str, data: Any):
+    try:
+        blob = json_dumps_bytes(data)
+    except Exception as e:
+        log.error("Save error: %s", e)
+        return
+    write_bytes_atomic(path, blob)
+
+def _hhmm_to_min(s: Any) -> Optional[int]:
+    """'HH:MM' -> minute of day (0-1439), or None if malformed."""
+    try:
+        return int(s[:2]) * 60 + int(s[3:5])
+    except Exception:
+        return None
+
+# Reverse index for timed events: field -> {minute_of_day: {chat_id_str}}.
+# Maintained under _io_lock by every write path so the scheduler only looks at
+# the users whose time matches the current minute.
+_TIME_INDEX: Dict[str, Dict[int, set]] = {
+    "morning_time": {},
+    "sleep_time": {},
+}
+_TIME_DEFAULTS = {"morning_time": "07:00", "sleep_time": "22:00"}
+
+def _index_times(cid_str: str, u: Dict, add: bool):
+    for field, index in _TIME_INDEX.items():
+        m = _hhmm_to_min(u.get(field, _TIME_DEFAULTS[field]))
+        if m is None:
+            continue
+        if add:
+            index.setdefault(m, set()).add(cid_str)
+        else:
+            bucket = index.get(m)
+            if bucket:
+                bucket.discard(cid_str)
+                if not bucket:
+                    del index[m]
+
+# Users with the bot enabled; the daily scheduler pass only walks these.
+# Guarded by _io_lock, kept in sync like _TIME_INDEX.
+_ACTIVE_USERS: set = set()
+# Users switched back on since the last scheduler pass; it visits them next so the
+# day reset isn't left waiting for their next water/timed event. Guarded by _io_lock.
+_REENABLED: set = set()
+
+def _index_active(cid_str: str, u: Dict):
+    if u.get("enabled"):
+        _ACTIVE_USERS.add(cid_str)
+    else:
+        _ACTIVE_USERS.discard(cid_str)
+
+# Water deadlines as a min-heap of (due_ts, chat_id_str). _WATER_NEXT holds each
+# user's current deadline; heap entries that disagree with it are stale and are
+# dropped lazily when they reach the top. Both guarded by _io_lock.
+_WATER_HEAP: List[Tuple[float, str]] = []
+_WATER_NEXT: Dict[str, float] = {}
+_WATER_FIELDS = frozenset(("enabled", "water_enabled", "water_reminder_interval_min", "last_water_reminder_ts"))
+
+def _water_due_ts(u: Dict) -> Optional[float]:
+    """Next water reminder time for u, or None if it gets none."""
+    if not (u.get("enabled") and u.get("water_enabled", True)):
+        return None
+    try:
+        return float(int(u.get("last_water_reminder_ts", 0)) + int(u.get("water_reminder_interval_min", 90)) * 60)
+    except Exception:
+        return None
+
+def _schedule_water(cid_str: str, due_ts: Optional[float]):
+    if due_ts is None:
+        _WATER_NEXT.pop(cid_str, None)
+        return
+    _WATER_NEXT[cid_str] = due_ts
+    heapq.heappush(_WATER_HEAP, (due_ts, cid_str))
+
+def _water_heap_top() -> Optional[float]:
+    """Earliest live water deadline (stale entries are discarded)."""
+    while _WATER_HEAP:
+        ts, cid_str = _WATER_HEAP[0]
+        if _WATER_NEXT.get(cid_str) == ts:
+            return ts
+        heapq.heappop(_WATER_HEAP)
+    return None
+
+# Fields that can move a user's next scheduled event earlier
+_SCHED_FIELDS = frozenset(("enabled", "water_enabled", "water_reminder_interval_min", "morning_time", "sleep_time"))
+
+def _patch_record(cid_str: str, u: Dict, patch: Dict[str, Any]):
+    """u.update(patch), keeping _TIME_INDEX, _ACTIVE_USERS and the water heap in sync. Caller holds _io_lock."""
+    if not _SCHED_FIELDS.isdisjoint(patch):
+        sched_wakeup.set()
+    if any(k in _TIME_INDEX for k in patch):
+        _index_times(cid_str, u, add=False)
+        u.update(patch)
+        _index_times(cid_str, u, add=True)
+    else:
+        u.update(patch)
+    if "enabled" in patch:
+        was_active = cid_str in _ACTIVE_USERS
+        _index_active(cid_str, u)
+        if not was_active and cid_str in _ACTIVE_USERS:
+            _REENABLED.add(cid_str)
+    if not _WATER_FIELDS.isdisjoint(patch):
+        _schedule_water(cid_str, _water_due_ts(u))
+
+def _user_path(cid_str: str) -> str:
+    return os.path.join(USERS_DIR, f"{cid_str}.json")
+
+# Written into the staging dir last, so USERS_DIR only counts once it has every user
+_MIGRATED_MARK = ".migrated"
+
+def _migrate_users_file(users: Dict[str, Any]):
+    """Write the legacy single-file users into a fresh USERS_DIR in one step."""
+    tmp_dir = USERS_DIR + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for cid_str, u in users.items():
+        with open(os.path.join(tmp_dir, f"{cid_str}.json"), "wb") as f:
+            f.write(json_dumps_bytes(u))
+    open(os.path.join(tmp_dir, _MIGRATED_MARK), "wb").close()
+    # Directory rename is atomic: a crash mid-migration just redoes it next boot
+    os.replace(tmp_dir, USERS_DIR)
+    if users:
+        log.info("💾 Migrated %d users from %s to %s/", len(users), USERS_FILE, USERS_DIR)
+
+def _read_users_dir() -> Dict[str, Any]:
+    users: Dict[str, Any] = {}
+    for fn in os.listdir(USERS_DIR):
+        if fn.endswith(".json"):
+            u = load_json(os.path.join(USERS_DIR, fn), None)
+            if isinstance(u, dict):
+                users[fn[:-5]] = u
+    return users
+
+def _load_users() -> Dict[str, Any]:
+    global _USERS_SHARDED
+    if os.path.isfile(os.path.join(USERS_DIR, _MIGRATED_MARK)):
+        _USERS_SHARDED = True
+        return {"users": _read_users_dir()}
+
+    legacy = load_json(USERS_FILE, {"users": {}})
+    users = {k: v for k, v in (legacy.get("users") or {}).items() if isinstance(v, dict)}
+    try:
+        if os.path.isdir(USERS_DIR):
+            # Unmarked dir: only changed users were flushed there after an earlier
+            # failed migration. They are newer than USERS_FILE; fold them back in.
+            users.update(_read_users_dir())
+            # Not save_json: it swallows errors, and the dir must outlive a failed write
+            with open(USERS_FILE + ".tmp", "wb") as f:
+                f.write(json_dumps_bytes({"users": users}))
+            os.replace(USERS_FILE + ".tmp", USERS_FILE)
+            shutil.rmtree(USERS_DIR)
+        _migrate_users_file(users)
+        _USERS_SHARDED = True
+    except Exception as e:
+        # Keep USERS_FILE authoritative; the migration is retried next boot
+        log.error("Users migration error: %s", e)
+    return {"users": users}
+
 def get_users() -> Dict[str, Any]:
-    return load_json(USERS_FILE, {"users": {}})
+    global _USERS_CACHE
+    if _USERS_CACHE is None:
+        _USERS_CACHE = _load_users()
+        for cid_str, u in _USERS_CACHE["users"].items():
+            _index_times(cid_str, u, add=True)
+            _index_active(cid_str, u)
+            _schedule_water(cid_str, _water_due_ts(u))
+    return _USERS_CACHE
+
+def set_users(*cids: str):
+    """Mark users dirty and wake run_users_writer (non-blocking). Caller holds _io_lock."""
+    _DIRTY_CIDS.update(cids)
+    try:
+        _save_queue.put_nowait(True)
+    except queue.Full:
+        pass
+
+def _snapshot_users() -> Dict[str, bytes]:
+    """Serialize just the dirty users under _io_lock."""
+    with _io_lock:
+        if not _DIRTY_CIDS or _USERS_CACHE is None:
+            return {}
+        users = _USERS_CACHE.get("users") or {}
+        blobs = {cid: json_dumps_bytes(users[cid]) for cid in _DIRTY_CIDS if cid in users}
+        _DIRTY_CIDS.clear()
+        return blobs
+
+def _snapshot_legacy() -> Optional[bytes]:
+    """Whole-store USERS_FILE blob if anything is dirty (migration not done yet)."""
+    with _io_lock:
+        if not _DIRTY_CIDS or _USERS_CACHE is None:
+            return None
+        _DIRTY_CIDS.clear()
+        return json_dumps_bytes(_USERS_CACHE)
+
+def flush_users():
+    with _write_lock:
+        if not _USERS_SHARDED:
+            blob = _snapshot_legacy()
+            if blob is not None:
+                write_bytes_atomic(USERS_FILE, blob)
+            return
+        snapshot = _snapshot_users()
+        if snapshot:
+            os.makedirs(USERS_DIR, exist_ok=True)
+            for cid_str, blob in snapshot.items():
+                write_bytes_atomic(_user_path(cid_str), blob)
+
+# Last-chance save if the process exits without reaching main()'s finally
+atexit.register(flush_users)
+
+def run_users_writer():
+    log.info("💾 Users writer started")
+    while not shutdown_event.is_set():
+        try:
+            _save_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        # Debounce: let a burst of clicks/scheduler patches land in one flush.
+        # On shutdown the wait returns early and the final flush_users() covers it.
+        shutdown_event.wait(USERS_SAVE_DEBOUNCE_SEC)
+        try:
+            flush_users()
+        except Exception as e:
+            log.warning("⚠️ Users write error: %s", e)
+
+# Immutable per-user defaults (mutable fields are created fresh in ensure_user)
+_DEFAULTS: Dict[str, Any] = {
+    "enabled": True,
+
+    # Water tracking
+    "water_enabled": True,
+    "water_goal_ml": 2000,
+    "water_drunk_ml": 0,
+    "water_reminder_interval_min": 90,
+    "last_water_reminder_ts": 0,
+
+    # Sleep time
+    "sleep_enabled": True,
+    "sleep_time": "22:00",
 
-def set_users(d: Dict[str, Any]):
-    save_json(USERS_FILE, d)
+    # Morning greeting
+    "morning_enabled": True,
+    "morning_time": "07:00",
+
+    # Pending input state (for ADD_DATE, etc.)
+    "pending": None,  # {"type":"add_date"} or None
+}
+
+def _with_defaults(u: Dict) -> Dict:
+    """Fill missing baseline fields into `u` in place (no I/O). Pass a private copy."""
+    for k, v in _DEFAULTS.items():
+        u.setdefault(k, v)
+    return u
+
+def _new_user() -> Dict[str, Any]:
+    """Fresh record: shared immutable defaults plus per-user mutable fields."""
+    u = dict(_DEFAULTS)
+    u.update({
+        "created_at": fmt_dt(),
+        "water_last_reset": now_vn().date().isoformat(),
+
+        # Important dates (personal)
+        "important_dates": {},  # { "MM-DD": "desc" }
+
+        # State
+        "last_fire": {},  # {event_key: [Y, M, D, h, m]}
+    })
+    return u
 
 def ensure_user(chat_id: Any) -> Dict[str, Any]:
+    """Return the live cached record (created if missing); update_user() mutates it in place."""
+    cid_str = str(chat_id)
+    # Fast path, no lock: a single dict lookup is atomic and records are never removed
+    cache = _USERS_CACHE
+    if cache is not None:
+        u = (cache.get("users") or {}).get(cid_str)
+        if u:
+            return u
     with _io_lock:
         data = get_users()
         users = data.setdefault("users", {})
-        u = users.get(str(chat_id))
+        u = users.get(cid_str)
         if not u:
-            u = {
-                "enabled": True,
-                "created_at": fmt_dt(),
-
-                # Water tracking
-                "water_enabled": True,
-                "water_goal_ml": 2000,
-                "water_drunk_ml": 0,
-                "water_last_reset": now_vn().strftime("%Y-%m-%d"),
-                "water_reminder_interval_min": 90,
-                "last_water_reminder_ts": 0,
-
-                # Sleep time
-                "sleep_enabled": True,
-                "sleep_time": "22:00",
-
-                # Morning greeting
-                "morning_enabled": True,
-                "morning_time": "07:00",
-
-                # Important dates (personal)
-                "important_dates": {},  # { "MM-DD": "desc" }
-
-                # Pending input state (for ADD_DATE, etc.)
-                "pending": None,  # {"type":"add_date"} or None
-
-                # State
-                "last_fire": {},  # {event_key: "YYYY-MM-DD HH:MM"}
-            }
-            users[str(chat_id)] = u
-            set_users(data)
+            u = _new_user()
+            users[cid_str] = u
+            _index_times(cid_str, u, add=True)
+            _index_active(cid_str, u)
+            _schedule_water(cid_str, _water_due_ts(u))
+            set_users(cid_str)
+            sched_wakeup.set()
         return u
 
 def update_user(chat_id: Any, patch: Dict[str, Any]):
     with _io_lock:
         data = get_users()
         u = data.setdefault("users", {}).setdefault(str(chat_id), {})
-        u.update(patch)
-        set_users(data)
+        _patch_record(str(chat_id), u, patch)
+        set_users(str(chat_id))
+
+def incr_user(chat_id: Any, key: str, delta: int, patch: Optional[Dict[str, Any]] = None) -> int:
+    """Atomically add delta to an int field (plus optional patch); returns the new value."""
+    with _io_lock:
+        data = get_users()
+        u = data.setdefault("users", {}).setdefault(str(chat_id), {})
+        value = int(u.get(key, 0)) + delta
+        _patch_record(str(chat_id), u, {**(patch or {}), key: value})
+        set_users(str(chat_id))
+        return value
+
+def apply_user_patches(patches: Dict[Any, Dict[str, Any]]):
+    """Apply many per-user patches with one lock round-trip and one save.
+
+    A "last_fire" entry is merged into the stored dict rather than replacing it.
+    """
+    if not patches:
+        return
+    with _io_lock:
+        data = get_users()
+        users = data.setdefault("users", {})
+        for chat_id, patch in patches.items():
+            u = users.setdefault(str(chat_id), {})
+            fired = patch.pop("last_fire", None)
+            if fired:
+                lf = u.get("last_fire")
+                if isinstance(lf, dict):
+                    lf.update(fired)
+                else:
+                    u["last_fire"] = fired
+            if patch:
+                _patch_record(str(chat_id), u, patch)
+        set_users(*(str(chat_id) for chat_id in patches))
 
 def patch_user_nested(chat_id: Any, key: str, value: Any):
     """Helper update a nested dict value safely."""
     with _io_lock:
         data = get_users()
         u = data.setdefault("users", {}).setdefault(str(chat_id), {})
-        u[key] = value
-        set_users(data)
+        _patch_record(str(chat_id), u, {key: value})
+        set_users(str(chat_id))
 
 def list_enabled_chat_ids() -> List[int]:
-    data = get_users()
+    with _io_lock:
+        items = list((get_users().get("users") or {}).items())
     out: List[int] = []
-    for cid_str, u in (data.get("users") or {}).items():
+    for cid_str, u in items:
         if isinstance(u, dict) and u.get("enabled"):
             try:
                 out.append(int(cid_str))
@@ -280,58 +654,137 @@ def list_enabled_chat_ids() -> List[int]:
 # TELEGRAM API
 # ==========================================================
 TG_API = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+# Per-request headers replace the pool defaults in urllib3, so repeat them here
+_JSON_HEADERS = {**HTTP.headers, "Content-Type": "application/json"}
 
-def tg_call(method: str, *, params=None, payload=None, read_timeout=TG_READ_TIMEOUT) -> Dict:
+def tg_call(method: str, *, params=None, payload=None, read_timeout=TG_READ_TIMEOUT,
+            http: Optional[urllib3.PoolManager] = None) -> Dict:
     url = f"{TG_API}/{method}"
-    timeout = (TG_CONNECT_TIMEOUT, read_timeout)
+    timeout = urllib3.Timeout(connect=TG_CONNECT_TIMEOUT, read=read_timeout)
+    http = http or HTTP
     try:
         if payload is not None:
-            r = HTTP.post(url, json=payload, params=params, timeout=timeout)
+            if params:
+                url = f"{url}?{urlencode(params)}"
+            r = http.request(
+                "POST", url,
+                body=json_dumps_compact(payload),
+                headers=_JSON_HEADERS,
+                timeout=timeout,
+            )
         else:
-            r = HTTP.get(url, params=params, timeout=timeout)
+            r = http.request("GET", url, fields=params, timeout=timeout)
         try:
-            return r.json()
+            return json_loads(r.data)
         except Exception:
-            return {"ok": False, "description": f"Non-JSON response: {r.text[:200]}"}
+            return {"ok": False, "description": f"Non-JSON response: {r.data[:200]!r}"}
     except Exception as e:
         return {"ok": False, "description": str(e)}
 
+TG_CHUNK = 3900  # Telegram limit ~4096 chars; giữ an toàn
+
+# Fields shared by every sendMessage; per-send payloads are built as {**_SEND_TMPL, ...}
+_SEND_TMPL = {"parse_mode": "HTML", "disable_web_page_preview": True}
+
+def _send_one(chat_id: Any, text: str, reply_markup) -> bool:
+    payload = {**_SEND_TMPL, "chat_id": chat_id, "text": text}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    d = tg_call("sendMessage", payload=payload)
+    if not d.get("ok"):
+        log.error("❌ Send failed: %s", d)
+        return False
+    return True
+
 def tg_send(chat_id: Any, text: str, reply_markup=None) -> bool:
-    # Telegram limit ~4096 chars; giữ an toàn
-    chunks = [text[i:i + 3900] for i in range(0, len(text), 3900)] or [""]
-    for chunk in chunks:
-        payload = {
-            "chat_id": chat_id,
-            "text": chunk,
-            "parse_mode": "HTML",
-            "disable_web_page_preview": True,
-        }
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
+    """reply_markup may be a dict or an already JSON-encoded string (see kb_*)."""
+    if len(text) <= TG_CHUNK:
+        # Fast path: almost every message fits in one request
+        return _send_one(chat_id, text, reply_markup)
 
-        d = tg_call("sendMessage", payload=payload)
-        if not d.get("ok"):
-            log.error("❌ Send failed: %s", d)
+    for i in range(0, len(text), TG_CHUNK):
+        if not _send_one(chat_id, text[i:i + TG_CHUNK], reply_markup):
             return False
     return True
 
+def tg_edit(chat_id: Any, message_id: Any, text: str, reply_markup=None) -> bool:
+    """Replace a message in place; falls back to a new message if it can't be edited."""
+    if message_id and len(text) <= TG_CHUNK:
+        payload = {**_SEND_TMPL, "chat_id": chat_id, "message_id": message_id, "text": text}
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        d = tg_call("editMessageText", payload=payload)
+        if d.get("ok") or "message is not modified" in str(d.get("description", "")):
+            return True
+        log.info("ℹ️ Edit failed, sending instead: %s", d.get("description"))
+    return tg_send(chat_id, text, reply_markup=reply_markup)
+
+SEND_Q: "queue.Queue[Tuple[Any, str, Any]]" = queue.Queue(maxsize=SEND_QUEUE_MAX)
+_send_rate_lock = threading.Lock()
+_next_send_at = 0.0
+
+def _wait_send_slot():
+    """Space sends 1/SEND_RATE_PER_SEC apart across all sender threads."""
+    global _next_send_at
+    with _send_rate_lock:
+        now = time.monotonic()
+        delay = _next_send_at - now
+        _next_send_at = max(now, _next_send_at) + 1.0 / SEND_RATE_PER_SEC
+    if delay > 0:
+        time.sleep(delay)
+
+def tg_send_async(chat_id: Any, text: str, reply_markup=None) -> bool:
+    """Queue a message for the sender threads; False if the queue is full."""
+    try:
+        SEND_Q.put_nowait((chat_id, text, reply_markup))
+        return True
+    except queue.Full:
+        log.error("❌ Send queue full, dropped message to %s", chat_id)
+        return False
+
+def run_sender():
+    while not shutdown_event.is_set():
+        try:
+            chat_id, text, reply_markup = SEND_Q.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            _wait_send_slot()
+            tg_send(chat_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            log.warning("⚠️ Sender error: %s", e)
+        finally:
+            SEND_Q.task_done()
+
+_ANSWER_POOL = ThreadPoolExecutor(max_workers=ANSWER_WORKERS, thread_name_prefix="tg-answer")
+
+def _answer_callback_now(cq_id: str, text: str):
+    d = tg_call("answerCallbackQuery", payload={"callback_query_id": cq_id, "text": text}, read_timeout=15)
+    if not d.get("ok"):
+        log.warning("⚠️ answerCallbackQuery failed: %s", d.get("description"))
+
 def tg_answer_callback(cq_id: str, text: str = ""):
-    tg_call("answerCallbackQuery", payload={"callback_query_id": cq_id, "text": text}, read_timeout=15)
+    """Fire-and-forget: the answer only clears the button spinner, so the handler doesn't wait on it."""
+    if cq_id:
+        _ANSWER_POOL.submit(_answer_callback_now, cq_id, text)
 
 # ==========================================================
 # UI
 # ==========================================================
-def kb_main(user: Dict) -> dict:
-    goal = max(1, int(user.get("water_goal_ml", 2000)))
-    drunk = max(0, int(user.get("water_drunk_ml", 0)))
-    water_pct = min(100, int(drunk / goal * 100))
-
-    bot_status = "🟢" if user.get("enabled") else "🔴"
-    water_status = "💧" if user.get("water_enabled") else "❌"
-    sleep_status = "🌙" if user.get("sleep_enabled") else "❌"
-    morning_status = "🌅" if user.get("morning_enabled") else "❌"
-
-    return {
+# Keyboards are pre-serialized to JSON strings once; Telegram accepts
+# reply_markup as a JSON-encoded string, so tg_send passes them through as-is.
+def _kb_json(kb: dict) -> str:
+    return json.dumps(kb, ensure_ascii=False, separators=(",", ":"))
+
+@functools.lru_cache(maxsize=256)
+def _kb_main_cached(enabled: bool, water_enabled: bool, sleep_enabled: bool,
+                    morning_enabled: bool, water_pct: int) -> str:
+    bot_status = "🟢" if enabled else "🔴"
+    water_status = "💧" if water_enabled else "❌"
+    sleep_status = "🌙" if sleep_enabled else "❌"
+    morning_status = "🌅" if morning_enabled else "❌"
+
+    return _kb_json({
         "inline_keyboard": [
             [{"text": f"{bot_status} Bot", "callback_data": "TOGGLE_BOT"}],
             [
@@ -344,101 +797,178 @@ def kb_main(user: Dict) -> dict:
             ],
             [{"text": "📊 Xem tổng quan", "callback_data": "SHOW_OVERVIEW"}],
         ]
-    }
+    })
 
-def kb_water() -> dict:
-    return {
-        "inline_keyboard": [
-            [{"text": "💧 Đã uống 250ml", "callback_data": "DRANK_250"}],
-            [{"text": "💧 Đã uống 500ml", "callback_data": "DRANK_500"}],
-            [{"text": "🔄 Reset hôm nay", "callback_data": "WATER_RESET"}],
-            [{"text": "⬅️ Quay lại", "callback_data": "BACK"}],
-        ]
-    }
+def kb_main(user: Dict) -> str:
+    goal = max(1, int(user.get("water_goal_ml", 2000)))
+    drunk = max(0, int(user.get("water_drunk_ml", 0)))
+    water_pct = min(100, int(drunk / goal * 100))
+    return _kb_main_cached(
+        bool(user.get("enabled")),
+        bool(user.get("water_enabled")),
+        bool(user.get("sleep_enabled")),
+        bool(user.get("morning_enabled")),
+        water_pct,
+    )
 
-def kb_dates() -> dict:
-    return {
-        "inline_keyboard": [
-            [{"text": "📅 Xem ngày lễ sắp tới", "callback_data": "VIEW_HOLIDAYS"}],
-            [{"text": "➕ Thêm ngày quan trọng", "callback_data": "ADD_DATE"}],
-            [{"text": "📋 Ngày của tôi", "callback_data": "MY_DATES"}],
-            [{"text": "⬅️ Quay lại", "callback_data": "BACK"}],
-        ]
-    }
+_KB_WATER = _kb_json({
+    "inline_keyboard": [
+        [{"text": "💧 Đã uống 250ml", "callback_data": "DRANK_250"}],
+        [{"text": "💧 Đã uống 500ml", "callback_data": "DRANK_500"}],
+        [{"text": "🔄 Reset hôm nay", "callback_data": "WATER_RESET"}],
+        [{"text": "⬅️ Quay lại", "callback_data": "BACK"}],
+    ]
+})
+
+_KB_DATES = _kb_json({
+    "inline_keyboard": [
+        [{"text": "📅 Xem ngày lễ sắp tới", "callback_data": "VIEW_HOLIDAYS"}],
+        [{"text": "➕ Thêm ngày quan trọng", "callback_data": "ADD_DATE"}],
+        [{"text": "📋 Ngày của tôi", "callback_data": "MY_DATES"}],
+        [{"text": "⬅️ Quay lại", "callback_data": "BACK"}],
+    ]
+})
+
+def kb_water() -> str:
+    return _KB_WATER
+
+def kb_dates() -> str:
+    return _KB_DATES
 
 # ==========================================================
 # MESSAGES
 # ==========================================================
+# Shared decorations, defined once
+_SEP = "━━━━━━━━━━━━━━━━━━━━\n"
+_OVERVIEW_HEADER = (
+    "╔════════════════════╗\n"
+    "║  🤖 <b>TRỢ LÝ NHẮC VIỆC</b> ║\n"
+    "╚════════════════════╝\n\n"
+)
+# First line of a sent overview as Telegram echoes it back (plain text, no HTML)
+_OVERVIEW_MARK = _OVERVIEW_HEADER.partition("\n")[0]
+
 def build_overview(u: Dict) -> str:
-    bot = "🟢 ĐANG BẬT" if u.get("enabled") else "🔴 ĐÃ TẮT"
+    # Everything the text depends on, as a hashable key (now_str changes once a minute)
+    pending = u.get("pending")
+    return _render_overview(
+        fmt_dt(),
+        bool(u.get("enabled")),
+        int(u.get("water_drunk_ml", 0)),
+        max(1, int(u.get("water_goal_ml", 2000))),
+        int(u.get("water_reminder_interval_min", 90)) if u.get("water_enabled") else None,
+        str(u.get("sleep_time", "22:00")) if u.get("sleep_enabled") else None,
+        str(u.get("morning_time", "07:00")) if u.get("morning_enabled") else None,
+        len(u.get("important_dates", {}) or {}),
+        bool(pending and isinstance(pending, dict)),
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _render_overview(now_str: str, enabled: bool, drunk: int, goal: int,
+                     water_interval: Optional[int], sleep_time: Optional[str],
+                     morning_time: Optional[str], dates_count: int, pending: bool) -> str:
+    """Pure renderer for build_overview; None means the feature is turned off."""
+    bot = "🟢 ĐANG BẬT" if enabled else "🔴 ĐÃ TẮT"
 
-    drunk = int(u.get("water_drunk_ml", 0))
-    goal = max(1, int(u.get("water_goal_ml", 2000)))
     pct = min(100, int(drunk / goal * 100))
     remaining = max(0, goal - drunk)
 
-    msg = "╔════════════════════╗\n"
-    msg += "║  🤖 <b>TRỢ LÝ NHẮC VIỆC</b> ║\n"
-    msg += "╚════════════════════╝\n\n"
-
-    msg += f"📊 <b>Trạng thái:</b> {bot}\n"
-    msg += f"🕐 <b>Bây giờ:</b> <code>{fmt_dt()}</code>\n\n"
-
-    msg += "━━━━━━━━━━━━━━━━━━━━\n"
-    msg += "<b>💧 UỐNG NƯỚC HÔM NAY</b>\n"
-    msg += f"• Đã uống: <b>{drunk}ml / {goal}ml</b> ({pct}%)\n"
-    msg += f"• Còn lại: <b>{remaining}ml</b>\n"
-    if u.get("water_enabled"):
-        msg += f"• Nhắc mỗi: <b>{int(u.get('water_reminder_interval_min', 90))}p</b>\n"
+    if water_interval is not None:
+        water_line = f"• Nhắc mỗi: <b>{water_interval}p</b>\n"
     else:
-        msg += "• Nhắc: <b>Đã tắt</b>\n"
+        water_line = "• Nhắc: <b>Đã tắt</b>\n"
 
-    msg += "\n━━━━━━━━━━━━━━━━━━━━\n"
-    msg += "<b>🌙 GIỜ NGỦ</b>\n"
-    if u.get("sleep_enabled"):
-        msg += f"• Nhắc lúc: <b>{u.get('sleep_time', '22:00')}</b>\n"
+    if sleep_time is not None:
+        sleep_line = f"• Nhắc lúc: <b>{sleep_time}</b>\n"
     else:
-        msg += "• <b>Đã tắt</b>\n"
+        sleep_line = "• <b>Đã tắt</b>\n"
 
-    msg += "\n━━━━━━━━━━━━━━━━━━━━\n"
-    msg += "<b>🌅 CHÀO BUỔI SÁNG</b>\n"
-    if u.get("morning_enabled"):
-        msg += f"• Nhắc lúc: <b>{u.get('morning_time', '07:00')}</b>\n"
-        msg += "• Kèm: Ngày lễ + Ngày quan trọng\n"
+    if morning_time is not None:
+        morning_lines = (
+            f"• Nhắc lúc: <b>{morning_time}</b>\n"
+            "• Kèm: Ngày lễ + Ngày quan trọng\n"
+        )
     else:
-        msg += "• <b>Đã tắt</b>\n"
+        morning_lines = "• <b>Đã tắt</b>\n"
 
-    dates_count = len(u.get("important_dates", {}) or {})
-    msg += "\n━━━━━━━━━━━━━━━━━━━━\n"
-    msg += "<b>📅 NGÀY QUAN TRỌNG</b>\n"
-    msg += f"• Bạn có: <b>{dates_count} ngày</b> đã lưu\n"
+    pending_line = "\n\n📝 <i>Bạn đang ở chế độ nhập liệu. Gõ /cancel để hủy.</i>" if pending else ""
 
-    pending = u.get("pending")
-    if pending and isinstance(pending, dict):
-        msg += "\n\n📝 <i>Bạn đang ở chế độ nhập liệu. Gõ /cancel để hủy.</i>"
+    return (
+        f"{_OVERVIEW_HEADER}"
+        f"📊 <b>Trạng thái:</b> {bot}\n"
+        f"🕐 <b>Bây giờ:</b> <code>{now_str}</code>\n\n"
+        f"{_SEP}"
+        "<b>💧 UỐNG NƯỚC HÔM NAY</b>\n"
+        f"• Đã uống: <b>{drunk}ml / {goal}ml</b> ({pct}%)\n"
+        f"• Còn lại: <b>{remaining}ml</b>\n"
+        f"{water_line}"
+        f"\n{_SEP}"
+        "<b>🌙 GIỜ NGỦ</b>\n"
+        f"{sleep_line}"
+        f"\n{_SEP}"
+        "<b>🌅 CHÀO BUỔI SÁNG</b>\n"
+        f"{morning_lines}"
+        f"\n{_SEP}"
+        "<b>📅 NGÀY QUAN TRỌNG</b>\n"
+        f"• Bạn có: <b>{dates_count} ngày</b> đã lưu\n"
+        f"{pending_line}"
+    )
 
-    return msg
+@functools.lru_cache(maxsize=8)
+def _upcoming_cached(date_iso: str, days: int) -> Tuple[Tuple[str, str], ...]:
+    """Scan `days` dates from `date_iso`; cached so it runs once per (day, days)."""
+    today = datetime.fromisoformat(date_iso)
+    upcoming: List[Tuple[str, str]] = []
+
+    for i in range(days):
+        d = today + timedelta(days=i)
+        mm_dd = f"{d.month:02d}-{d.day:02d}"
+        name = check_holiday(mm_dd)
+        if name:
+            upcoming.append((d.date().isoformat(), name))
+
+    return tuple(upcoming)
 
 def get_upcoming_holidays(days: int = 30) -> List[Tuple[datetime, str]]:
     today = now_vn().replace(hour=0, minute=0, second=0, microsecond=0)
-    upcoming: List[Tuple[datetime, str]] = []
+    return [
+        (datetime.fromisoformat(iso).replace(tzinfo=today.tzinfo), name)
+        for iso, name in _upcoming_cached(today.date().isoformat(), days)
+    ]
+
+def get_upcoming_events(u: Dict, days: int = 7) -> List[Tuple[datetime, str, str]]:
+    """Holidays and the user's important dates in one pass: (date, source, name)."""
+    today = now_vn().replace(hour=0, minute=0, second=0, microsecond=0)
+    personal_dates = u.get("important_dates", {}) or {}
+    events: List[Tuple[datetime, str, str]] = []
 
     for i in range(days):
         d = today + timedelta(days=i)
-        mm_dd = d.strftime("%m-%d")
-        name = check_holiday(mm_dd)
-        if name:
-            upcoming.append((d, name))
+        mm_dd = f"{d.month:02d}-{d.day:02d}"
+        holiday = _ALL_HOLIDAYS.get(mm_dd)
+        if holiday:
+            events.append((d, "holiday", holiday))
+        personal = personal_dates.get(mm_dd)
+        if personal:
+            events.append((d, "personal", personal))
+
+    return events
 
-    return upcoming
+_HOLIDAYS_HEADER = "📅 <b>NGÀY LỄ SẮP TỚI</b>\n\n"
+_NO_HOLIDAYS_MSG = _HOLIDAYS_HEADER + "⚠️ Không có ngày lễ nào trong 60 ngày tới.\n"
 
 def build_holidays_message() -> str:
-    upcoming = get_upcoming_holidays(60)
+    # Same text all day: render once per date (also covers the year rollover)
+    return _holidays_message_cached(now_vn().date().isoformat())
 
-    msg = "📅 <b>NGÀY LỄ SẮP TỚI</b>\n\n"
+@functools.lru_cache(maxsize=2)
+def _holidays_message_cached(date_iso: str) -> str:
+    """date_iso is only the cache key; the body reads the same day via now_vn()."""
+    upcoming = get_upcoming_holidays(60)
     if not upcoming:
-        msg += "⚠️ Không có ngày lễ nào trong 60 ngày tới.\n"
-        return msg
+        return _NO_HOLIDAYS_MSG
+
+    parts = [_HOLIDAYS_HEADER]
 
     today = now_vn().replace(hour=0, minute=0, second=0, microsecond=0)
     for d, name in upcoming[:10]:
@@ -450,71 +980,90 @@ def build_holidays_message() -> str:
         else:
             when = f"Còn {days_left} ngày"
 
-        msg += f"• {name}\n"
-        msg += f"  📆 {d.strftime('%d/%m/%Y')} ({when})\n\n"
+        parts.append(f"• {name}\n  📆 {d.day:02d}/{d.month:02d}/{d.year} ({when})\n\n")
+
+    return "".join(parts)
 
-    return msg
+_WEEKDAY_NAMES = ("Hai", "Ba", "Tư", "Năm", "Sáu", "Bảy", "CN")
 
 def build_morning_greeting(u: Dict) -> str:
     today = now_vn()
-    mm_dd = today.strftime("%m-%d")
+    today0 = today.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    holiday_line = ""
+    personal_line = ""
+    future: List[str] = []
+    for d, source, name in get_upcoming_events(u, 7):
+        if d > today0:
+            label = name if source == "holiday" else f"⭐ {name}"
+            future.append(f"• {label} ({(d - today0).days} ngày nữa)\n")
+        elif source == "holiday":
+            holiday_line = f"🎉 <b>{name}</b>\n\n"
+        else:
+            personal_line = f"⭐ <b>{name}</b>\n\n"
 
-    weekday_names = ["Hai", "Ba", "Tư", "Năm", "Sáu", "Bảy", "CN"]
-    msg = "🌅 <b>CHÀO BUỔI SÁNG!</b>\n\n"
-    msg += f"📅 Hôm nay: <b>{today.strftime('%d/%m/%Y')}</b>\n"
-    msg += f"📆 Thứ: <b>{weekday_names[today.weekday()]}</b>\n\n"
+    upcoming_block = "📌 <b>Sắp tới:</b>\n" + "".join(future[:3]) + "\n" if future else ""
 
-    holiday = check_holiday(mm_dd)
-    if holiday:
-        msg += f"🎉 <b>{holiday}</b>\n\n"
+    return (
+        "🌅 <b>CHÀO BUỔI SÁNG!</b>\n\n"
+        f"📅 Hôm nay: <b>{today.day:02d}/{today.month:02d}/{today.year}</b>\n"
+        f"📆 Thứ: <b>{_WEEKDAY_NAMES[today.weekday()]}</b>\n\n"
+        f"{holiday_line}"
+        f"{personal_line}"
+        f"{upcoming_block}"
+        "💪 Chúc bạn một ngày tuyệt vời!\n"
+        "💧 Nhớ uống nước đầy đủ nhé!"
+    )
 
-    personal_dates = u.get("important_dates", {}) or {}
-    if mm_dd in personal_dates:
-        msg += f"⭐ <b>{personal_dates[mm_dd]}</b>\n\n"
-
-    upcoming = get_upcoming_holidays(7)
-    if upcoming:
-        today0 = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        future = [(d, name) for d, name in upcoming if d > today0]
-        if future:
-            msg += "📌 <b>Sắp tới:</b>\n"
-            for d, name in future[:3]:
-                days = (d - today0).days
-                msg += f"• {name} ({days} ngày nữa)\n"
-            msg += "\n"
-
-    msg += "💪 Chúc bạn một ngày tuyệt vời!\n"
-    msg += "💧 Nhớ uống nước đầy đủ nhé!"
-    return msg
+_HELP_TEXT = (
+    "🤖 <b>Trợ lý nhắc việc</b>\n"
+    + _SEP +
+    "• /start : Bắt đầu dùng bot\n"
+    "• /overview : Xem tổng quan\n"
+    "• /water : Menu uống nước\n"
+    "• /dates : Menu ngày lễ / ngày quan trọng\n"
+    "• /cancel : Hủy chế độ nhập (thêm ngày)\n"
+    "• /stop : Tắt bot (không gửi nhắc)\n"
+)
 
 def help_text() -> str:
-    return (
-        "🤖 <b>Trợ lý nhắc việc</b>\n"
-        "━━━━━━━━━━━━━━━━━━━━\n"
-        "• /start : Bắt đầu dùng bot\n"
-        "• /overview : Xem tổng quan\n"
-        "• /water : Menu uống nước\n"
-        "• /dates : Menu ngày lễ / ngày quan trọng\n"
-        "• /cancel : Hủy chế độ nhập (thêm ngày)\n"
-        "• /stop : Tắt bot (không gửi nhắc)\n"
-    )
+    return _HELP_TEXT
 
 # ==========================================================
 # DATE INPUT PARSING (PERSONAL IMPORTANT DATES)
 # ==========================================================
-_MM_DD_RE = re.compile(r"^\s*(\d{1,2})\s*[-/\.]\s*(\d{1,2})\s*(.*)$")
+_MM_DD_SEPS = "-/."
 
 def normalize_mm_dd(text: str) -> Optional[Tuple[str, str]]:
     """
     Parse: 'MM-DD noi dung' or 'MM/DD noi dung' or 'MM.DD noi dung'
     Return: (mm_dd, desc) or None.
     """
-    m = _MM_DD_RE.match(text or "")
-    if not m:
+    text = text or ""
+    positions = [p for p in (text.find(c) for c in _MM_DD_SEPS) if p >= 0]
+    if not positions:
         return None
-    mm = int(m.group(1))
-    dd = int(m.group(2))
-    desc = (m.group(3) or "").strip()
+    sep = min(positions)
+
+    mm_s = text[:sep].strip()
+    if not (1 <= len(mm_s) <= 2 and mm_s.isdecimal()):
+        return None
+
+    rest = text[sep + 1:].lstrip()
+    n = 0
+    while n < 2 and n < len(rest) and rest[n].isdecimal():
+        n += 1
+    if n == 0:
+        return None
+
+    desc = rest[n:].lstrip()
+    # Single-line description only (a trailing newline is tolerated)
+    if "\n" in (desc[:-1] if desc.endswith("\n") else desc):
+        return None
+
+    mm = int(mm_s)
+    dd = int(rest[:n])
+    desc = desc.strip()
 
     if not (1 <= mm <= 12 and 1 <= dd <= 31):
         return None
@@ -522,152 +1071,277 @@ def normalize_mm_dd(text: str) -> Optional[Tuple[str, str]]:
     mm_dd = f"{mm:02d}-{dd:02d}"
     return mm_dd, desc
 
+_ADD_DATE_PROMPT = (
+    "➕ <b>THÊM NGÀY QUAN TRỌNG</b>\n\n"
+    "Hãy gửi theo format:\n"
+    "• <code>MM-DD Nội dung</code>\n"
+    "Ví dụ:\n"
+    "• <code>03-15 Sinh nhật mẹ</code>\n"
+    "• <code>12-01 Kỷ niệm cưới</code>\n\n"
+    "Gõ /cancel để hủy."
+)
+
 def build_add_date_prompt() -> str:
-    return (
-        "➕ <b>THÊM NGÀY QUAN TRỌNG</b>\n\n"
-        "Hãy gửi theo format:\n"
-        "• <code>MM-DD Nội dung</code>\n"
-        "Ví dụ:\n"
-        "• <code>03-15 Sinh nhật mẹ</code>\n"
-        "• <code>12-01 Kỷ niệm cưới</code>\n\n"
-        "Gõ /cancel để hủy."
-    )
+    return _ADD_DATE_PROMPT
 
 # ==========================================================
 # SCHEDULER
 # ==========================================================
-def should_fire(u: Dict, event_key: str, now: datetime) -> bool:
-    last = (u.get("last_fire", {}) or {}).get(event_key)
-    k = now.strftime("%Y-%m-%d %H:%M")
-    return last != k
+def _minute_key(now: datetime) -> Tuple[int, int, int, int, int]:
+    return (now.year, now.month, now.day, now.hour, now.minute)
+
+def should_fire(u: Dict, event_key: str, fire_key: List[int]) -> bool:
+    # fire_key is list(_minute_key(now)), built once per tick; it is stored as a
+    # JSON list [Y, M, D, h, m], so older string values simply mismatch
+    return (u.get("last_fire", {}) or {}).get(event_key) != fire_key
+
+def mark_fired(patches: Dict[int, Dict[str, Any]], chat_id: int, event_key: str, fire_key: List[int]):
+    """Record a fired event in this tick's batch; merged in by apply_user_patches."""
+    patches.setdefault(chat_id, {}).setdefault("last_fire", {})[event_key] = fire_key
 
-def mark_fired(chat_id: Any, u: Dict, event_key: str, now: datetime):
-    lf = dict(u.get("last_fire", {}) or {})
-    lf[event_key] = now.strftime("%Y-%m-%d %H:%M")
-    update_user(chat_id, {"last_fire": lf})
+def reset_water_if_needed(patches: Dict[int, Dict[str, Any]], chat_id: int, u: Dict,
+                          today: Optional[str] = None) -> Dict:
+    """Reset water counter at midnight (batched); return updated user dict.
 
-def reset_water_if_needed(chat_id: Any, u: Dict) -> Dict:
-    """Reset water counter at midnight; return updated user dict."""
-    today = now_vn().strftime("%Y-%m-%d")
+    today is the ISO date, computed once per tick by the scheduler.
+    """
+    today = today or now_vn().date().isoformat()
     last_reset = u.get("water_last_reset", "")
     if last_reset != today:
         patch = {"water_drunk_ml": 0, "water_last_reset": today}
-        update_user(chat_id, patch)
+        patches.setdefault(chat_id, {}).update(patch)
         u = dict(u)
         u.update(patch)
     return u
 
+_SLEEP_REMINDER_MSG = (
+    "🌙 <b>GIỜ ĐI NGỦ RỒI!</b>\n\n"
+    "💤 Tắt điện thoại\n"
+    "📖 Đọc sách hoặc nghe nhạc nhẹ\n"
+    "🧘 Thở sâu và thư giãn\n\n"
+    "Chúc bạn ngủ ngon! 😴"
+)
+
+# Daily timed events: (event_key, enabled_field, time_field, message builder).
+# time_field must be a _TIME_INDEX key; event_key is the last_fire slot.
+_TIMED_EVENTS: Tuple[Tuple[str, str, str, Callable[[Dict], str]], ...] = (
+    ("morning", "morning_enabled", "morning_time", build_morning_greeting),
+    ("sleep", "sleep_enabled", "sleep_time", lambda u: _SLEEP_REMINDER_MSG),
+)
+
+# Water reminders only during waking hours: [07:00, 22:00) as minute of day
+WATER_START_MIN = 7 * 60
+WATER_END_MIN = 22 * 60
+
+def _water_open(now_min: int) -> bool:
+    return WATER_START_MIN <= now_min < WATER_END_MIN
+
+WATER_RETRY_SEC = 60  # re-check a due user if its reminder somehow didn't go out
+
+def _water_due_ids(now_min: int, now_ts: float) -> List[str]:
+    """Pop users whose water deadline has passed. Caller holds _io_lock.
+
+    Sending the reminder stamps last_water_reminder_ts, which reschedules the user
+    through _patch_record; the retry entry pushed here is then stale.
+    """
+    if not _water_open(now_min):
+        return []
+    out: List[str] = []
+    while True:
+        ts = _water_heap_top()
+        if ts is None or ts > now_ts:
+            break
+        _, cid_str = heapq.heappop(_WATER_HEAP)
+        out.append(cid_str)
+        _schedule_water(cid_str, now_ts + WATER_RETRY_SEC)
+    return out
+
+def _next_event_min(now_min: int) -> int:
+    """Next minute of day after now_min with a timed event; 1440 (midnight) at the latest.
+
+    Caller holds _io_lock.
+    """
+    best = 24 * 60  # day rollover: water reset pass
+    if now_min < WATER_START_MIN:
+        best = WATER_START_MIN  # overnight-due water reminders
+    for index in _TIME_INDEX.values():
+        for m in index:
+            if now_min < m < best:
+                best = m
+    return best
+
+def _next_wakeup_delay(now: datetime) -> float:
+    """Seconds until the next timed event, midnight, or water deadline, whichever is first."""
+    now_ts = time.time()
+    now_min = now.hour * 60 + now.minute
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    with _io_lock:
+        target = day_start + timedelta(minutes=_next_event_min(now_min))
+        delay = (target - now_vn()).total_seconds()
+
+        if _water_open(now_min):
+            water_ts = _water_heap_top()
+            if water_ts is not None:
+                delay = min(delay, water_ts - now_ts)
+
+    ping_delay = SELF_PING.delay()
+    if ping_delay is not None:
+        delay = min(delay, ping_delay)
+
+    return max(SCHED_MIN_DELAY_SEC, delay)
+
 def scheduler_loop():
     log.info("⏰ Scheduler started")
+    last_minute: Optional[Tuple[int, int, int, int, int]] = None
+    last_day: Optional[Tuple[int, int, int]] = None
 
     while not shutdown_event.is_set():
+        dirty_patches: Dict[int, Dict[str, Any]] = {}
         try:
-            data = get_users()
-            users = data.get("users", {}) or {}
             now = now_vn()
-            hhmm = now.strftime("%H:%M")
-
-            for cid_str, u in list(users.items()):
-                if not isinstance(u, dict):
-                    continue
-                if not u.get("enabled"):
-                    continue
-
+            now_min = now.hour * 60 + now.minute
+            now_ts = time.time()
+            water_open = _water_open(now_min)
+            current_minute = _minute_key(now)
+            fire_key = list(current_minute)
+            today_iso = now.date().isoformat()
+            with _io_lock:
+                users = get_users().get("users", {}) or {}
+                # Users whose pre-parsed morning/sleep minute is now (from _TIME_INDEX)
+                due_now = {
+                    field: frozenset(_TIME_INDEX[field].get(now_min, ()))
+                    for _, _, field, _ in _TIMED_EVENTS
+                }
+                if current_minute[:3] != last_day:
+                    # First pass of the day visits every active user (midnight water reset)
+                    ids = set(_ACTIVE_USERS)
+                else:
+                    ids = set(_water_due_ids(now_min, now_ts))
+                    # Timed events only change on a new minute
+                    if current_minute != last_minute:
+                        for due_ids in due_now.values():
+                            ids |= due_ids
+                    ids |= _REENABLED
+                _REENABLED.clear()
+                # Shallow per-user copies: the pass below runs without _io_lock
+                candidates = [
+                    (cid_str, users[cid_str].copy()) for cid_str in ids
+                    if isinstance(users.get(cid_str), dict) and users[cid_str].get("enabled")
+                ]
+            last_minute = current_minute
+            last_day = current_minute[:3]
+
+            for cid_str, u in candidates:
                 try:
                     chat_id = int(cid_str)
                 except Exception:
                     continue
 
-                # Ensure baseline fields (in case file edited)
-                u = ensure_user(chat_id)
-                u = reset_water_if_needed(chat_id, u)
+                # Fill baseline fields (in case file edited) on the snapshot copy
+                u = _with_defaults(u)
+                u = reset_water_if_needed(dirty_patches, chat_id, u, today_iso)
 
-                # Morning greeting
-                if u.get("morning_enabled"):
-                    if hhmm == u.get("morning_time", "07:00") and should_fire(u, "morning", now):
-                        tg_send(chat_id, build_morning_greeting(u), reply_markup=kb_main(u))
-                        mark_fired(chat_id, u, "morning", now)
+                # Morning greeting / sleep reminder
+                for event_key, enabled_field, time_field, build in _TIMED_EVENTS:
+                    if u.get(enabled_field) and cid_str in due_now[time_field] and should_fire(u, event_key, fire_key):
+                        tg_send_async(chat_id, build(u), kb_main(u))
+                        mark_fired(dirty_patches, chat_id, event_key, fire_key)
 
-                # Sleep reminder
-                if u.get("sleep_enabled"):
-                    if hhmm == u.get("sleep_time", "22:00") and should_fire(u, "sleep", now):
-                        msg = (
-                            "🌙 <b>GIỜ ĐI NGỦ RỒI!</b>\n\n"
-                            "💤 Tắt điện thoại\n"
-                            "📖 Đọc sách hoặc nghe nhạc nhẹ\n"
-                            "🧘 Thở sâu và thư giãn\n\n"
-                            "Chúc bạn ngủ ngon! 😴"
-                        )
-                        tg_send(chat_id, msg, reply_markup=kb_main(u))
-                        mark_fired(chat_id, u, "sleep", now)
-
-                # Water reminder
-                if u.get("water_enabled"):
+                # Water reminder (window checked once per tick above)
+                if water_open and u.get("water_enabled"):
                     interval_min = int(u.get("water_reminder_interval_min", 90))
                     last_ts = int(u.get("last_water_reminder_ts", 0))
 
-                    # Only remind during waking hours (7am - 10pm)
-                    if 7 <= now.hour < 22:
-                        if time.time() - last_ts >= interval_min * 60:
-                            drunk = int(u.get("water_drunk_ml", 0))
-                            goal = max(1, int(u.get("water_goal_ml", 2000)))
-                            remaining = max(0, goal - drunk)
-
-                            msg = (
-                                "💧 <b>UỐNG NƯỚC NÀO!</b>\n\n"
-                                f"🎯 Mục tiêu hôm nay: <b>{goal}ml</b>\n"
-                                f"✅ Đã uống: <b>{drunk}ml</b>\n"
-                                f"📊 Còn lại: <b>{remaining}ml</b>\n\n"
-                                "Bấm nút bên dưới sau khi uống! 👇"
-                            )
-                            tg_send(chat_id, msg, reply_markup=kb_water())
-                            update_user(chat_id, {"last_water_reminder_ts": int(time.time())})
+                    if now_ts - last_ts >= interval_min * 60:
+                        drunk = int(u.get("water_drunk_ml", 0))
+                        goal = max(1, int(u.get("water_goal_ml", 2000)))
+                        remaining = max(0, goal - drunk)
+
+                        msg = (
+                            "💧 <b>UỐNG NƯỚC NÀO!</b>\n\n"
+                            f"🎯 Mục tiêu hôm nay: <b>{goal}ml</b>\n"
+                            f"✅ Đã uống: <b>{drunk}ml</b>\n"
+                            f"📊 Còn lại: <b>{remaining}ml</b>\n\n"
+                            "Bấm nút bên dưới sau khi uống! 👇"
+                        )
+                        tg_send_async(chat_id, msg, kb_water())
+                        dirty_patches.setdefault(chat_id, {})["last_water_reminder_ts"] = int(now_ts)
 
         except Exception as e:
             log.exception("Scheduler error: %s", e)
 
-        time.sleep(SCHED_TICK)
+        try:
+            SELF_PING.maybe_ping()
+        except Exception as e:
+            log.warning("⚠️ Self-ping schedule error: %s", e)
+
+        # One storage write for everything this tick changed
+        try:
+            apply_user_patches(dirty_patches)
+        except Exception as e:
+            log.exception("Scheduler save error: %s", e)
+
+        # Clear before computing the delay: changes after this point set it again
+        sched_wakeup.clear()
+        try:
+            delay = _next_wakeup_delay(now_vn())
+        except Exception as e:
+            log.exception("Scheduler delay error: %s", e)
+            delay = SCHED_MIN_DELAY_SEC
+        sched_wakeup.wait(delay)
 
 # ==========================================================
 # COMMANDS + MESSAGE HANDLING
 # ==========================================================
+# Command handlers: (chat_id, user) -> None
+def _cmd_start(chat_id: int, u: Dict):
+    # bật bot + clear pending
+    update_user(chat_id, {"enabled": True, "pending": None})
+    tg_send(chat_id, "✅ <b>Đã sẵn sàng!</b>\n\n" + build_overview(u), reply_markup=kb_main(u))
+
+def _cmd_stop(chat_id: int, u: Dict):
+    update_user(chat_id, {"enabled": False, "pending": None})
+    tg_send(chat_id, "🛑 <b>Đã tắt bot.</b>\nGõ /start để bật lại.", reply_markup=kb_main(u))
+
+def _cmd_help(chat_id: int, u: Dict):
+    tg_send(chat_id, help_text(), reply_markup=kb_main(u))
+
+def _cmd_overview(chat_id: int, u: Dict):
+    tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
+
+def _cmd_water(chat_id: int, u: Dict):
+    tg_send(chat_id, "💧 <b>Menu uống nước</b>\n\nBấm nút bên dưới:", reply_markup=kb_water())
+
+def _cmd_dates(chat_id: int, u: Dict):
+    tg_send(chat_id, "📅 <b>QUẢN LÝ NGÀY</b>\n\nChọn chức năng:", reply_markup=kb_dates())
+
+def _cmd_cancel(chat_id: int, u: Dict):
+    update_user(chat_id, {"pending": None})
+    tg_send(chat_id, "✅ Đã hủy chế độ nhập.", reply_markup=kb_main(u))
+
+# Each command also answers to its bare word ("start", "help", ...)
+COMMANDS: Dict[str, Callable[[int, Dict], None]] = {
+    key: handler
+    for name, handler in (
+        ("start", _cmd_start),
+        ("stop", _cmd_stop),
+        ("help", _cmd_help),
+        ("overview", _cmd_overview),
+        ("water", _cmd_water),
+        ("dates", _cmd_dates),
+        ("cancel", _cmd_cancel),
+    )
+    for key in ("/" + name, name)
+}
+
 def handle_command(chat_id: int, text: str):
     u = ensure_user(chat_id)
     t = (text or "").strip()
 
-    if t.lower() in ("/start", "start"):
-        # bật bot + clear pending
-        update_user(chat_id, {"enabled": True, "pending": None})
-        u = ensure_user(chat_id)
-        tg_send(chat_id, "✅ <b>Đã sẵn sàng!</b>\n\n" + build_overview(u), reply_markup=kb_main(u))
-        return
-
-    if t.lower() in ("/stop", "stop"):
-        update_user(chat_id, {"enabled": False, "pending": None})
-        u = ensure_user(chat_id)
-        tg_send(chat_id, "🛑 <b>Đã tắt bot.</b>\nGõ /start để bật lại.", reply_markup=kb_main(u))
-        return
-
-    if t.lower() in ("/help", "help"):
-        tg_send(chat_id, help_text(), reply_markup=kb_main(u))
-        return
-
-    if t.lower() in ("/overview", "overview"):
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
-
-    if t.lower() in ("/water", "water"):
-        tg_send(chat_id, "💧 <b>Menu uống nước</b>\n\nBấm nút bên dưới:", reply_markup=kb_water())
-        return
-
-    if t.lower() in ("/dates", "dates"):
-        tg_send(chat_id, "📅 <b>QUẢN LÝ NGÀY</b>\n\nChọn chức năng:", reply_markup=kb_dates())
-        return
-
-    if t.lower() in ("/cancel", "cancel"):
-        update_user(chat_id, {"pending": None})
-        u = ensure_user(chat_id)
-        tg_send(chat_id, "✅ Đã hủy chế độ nhập.", reply_markup=kb_main(u))
+    # Lower-cased once; one dict lookup instead of a compare per command
+    handler = COMMANDS.get(t.lower())
+    if handler is not None:
+        handler(chat_id, u)
         return
 
     # If pending input
@@ -689,7 +1363,6 @@ def handle_command(chat_id: int, text: str):
             dates = dict(u.get("important_dates", {}) or {})
             dates[mm_dd] = desc
             update_user(chat_id, {"important_dates": dates, "pending": None})
-            u = ensure_user(chat_id)
 
             tg_send(
                 chat_id,
@@ -700,7 +1373,6 @@ def handle_command(chat_id: int, text: str):
 
         # Unknown pending -> clear
         update_user(chat_id, {"pending": None})
-        u = ensure_user(chat_id)
         tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
         return
 
@@ -710,6 +1382,100 @@ def handle_command(chat_id: int, text: str):
 # ==========================================================
 # CALLBACK HANDLING
 # ==========================================================
+# Callback handlers: (chat_id, user, cq_id) -> True to reply with the overview
+def _cb_toggle_bot(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    update_user(chat_id, {"enabled": not bool(u.get("enabled")), "pending": None})
+    tg_answer_callback(cq_id, "✅ Đã cập nhật")
+    return True
+
+def _cb_toggle(field: str, chat_id: Any, u: Dict, cq_id: str) -> bool:
+    update_user(chat_id, {field: not bool(u.get(field))})
+    tg_answer_callback(cq_id, "✅")
+    return True
+
+def _cb_show_overview(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "📊")
+    return True
+
+def _cb_water_menu(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "💧")
+    drunk = int(u.get("water_drunk_ml", 0))
+    goal = max(1, int(u.get("water_goal_ml", 2000)))
+    pct = min(100, int(drunk / goal * 100))
+    msg = (
+        "💧 <b>UỐNG NƯỚC HÔM NAY</b>\n\n"
+        f"📊 Tiến độ: <b>{pct}%</b>\n"
+        f"✅ Đã uống: <b>{drunk}ml</b>\n"
+        f"🎯 Mục tiêu: <b>{goal}ml</b>\n\n"
+        "Bấm nút sau khi uống:"
+    )
+    tg_send(chat_id, msg, reply_markup=kb_water())
+    return False
+
+def _cb_drank(amount: int, chat_id: Any, u: Dict, cq_id: str) -> bool:
+    # Read-modify-write under one lock so rapid double taps both count
+    incr_user(chat_id, "water_drunk_ml", amount, {"last_water_reminder_ts": int(time.time())})
+    tg_answer_callback(cq_id, f"✅ +{amount}ml")
+    return True
+
+def _cb_water_reset(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    update_user(chat_id, {"water_drunk_ml": 0})
+    tg_answer_callback(cq_id, "🔄 Đã reset")
+    return True
+
+def _cb_dates_menu(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "📅")
+    update_user(chat_id, {"pending": None})
+    tg_send(chat_id, "📅 <b>QUẢN LÝ NGÀY</b>\n\nChọn chức năng:", reply_markup=kb_dates())
+    return False
+
+def _cb_view_holidays(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "📅")
+    tg_send(chat_id, build_holidays_message(), reply_markup=kb_dates())
+    return False
+
+def _cb_my_dates(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "📋")
+    dates = u.get("important_dates", {}) or {}
+    if not dates:
+        msg = "📋 <b>NGÀY QUAN TRỌNG CỦA BẠN</b>\n\n⚠️ Bạn chưa có ngày nào."
+    else:
+        msg = (
+            "📋 <b>NGÀY QUAN TRỌNG CỦA BẠN</b>\n\n"
+            + "".join(f"• <b>{mm_dd}</b>: {desc}\n" for mm_dd, desc in sorted(dates.items()))
+            + "\n\nGợi ý: Muốn sửa, chỉ cần thêm lại đúng <code>MM-DD</code> là sẽ ghi đè."
+        )
+    tg_send(chat_id, msg, reply_markup=kb_dates())
+    return False
+
+def _cb_add_date(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    # chuyển sang chế độ nhập (pending)
+    tg_answer_callback(cq_id, "➕")
+    update_user(chat_id, {"pending": {"type": "add_date"}})
+    tg_send(chat_id, build_add_date_prompt(), reply_markup=kb_dates())
+    return False
+
+def _cb_back(chat_id: Any, u: Dict, cq_id: str) -> bool:
+    tg_answer_callback(cq_id, "⬅️")
+    update_user(chat_id, {"pending": None})
+    return True
+
+CALLBACK_HANDLERS: Dict[str, Callable[[Any, Dict, str], bool]] = {
+    "TOGGLE_BOT": _cb_toggle_bot,
+    "TOGGLE_SLEEP": functools.partial(_cb_toggle, "sleep_enabled"),
+    "TOGGLE_MORNING": functools.partial(_cb_toggle, "morning_enabled"),
+    "SHOW_OVERVIEW": _cb_show_overview,
+    "WATER_MENU": _cb_water_menu,
+    "DRANK_250": functools.partial(_cb_drank, 250),
+    "DRANK_500": functools.partial(_cb_drank, 500),
+    "WATER_RESET": _cb_water_reset,
+    "DATES_MENU": _cb_dates_menu,
+    "VIEW_HOLIDAYS": _cb_view_holidays,
+    "MY_DATES": _cb_my_dates,
+    "ADD_DATE": _cb_add_date,
+    "BACK": _cb_back,
+}
+
 def handle_callback(cq: Dict):
     cq_id = cq.get("id", "")
     msg_obj = cq.get("message") or {}
@@ -721,121 +1487,259 @@ def handle_callback(cq: Dict):
         tg_answer_callback(cq_id, "Thiếu chat_id")
         return
 
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None:
+        tg_answer_callback(cq_id, "Không hỗ trợ")
+        return
+
     u = ensure_user(chat_id)
+    if handler(chat_id, u, cq_id):
+        text, markup = build_overview(u), kb_main(u)
+        if (msg_obj.get("text") or "").startswith(_OVERVIEW_MARK):
+            # The button sits under an overview: redraw it instead of posting a new one
+            tg_edit(chat_id, msg_obj.get("message_id"), text, reply_markup=markup)
+        else:
+            # Greetings, reminders, help etc. keep their content
+            tg_send(chat_id, text, reply_markup=markup)
 
-    if action == "TOGGLE_BOT":
-        newv = not bool(u.get("enabled"))
-        update_user(chat_id, {"enabled": newv, "pending": None})
-        tg_answer_callback(cq_id, "✅ Đã cập nhật")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
+# ==========================================================
+# UPDATES LOOP
+# ==========================================================
+EXECUTOR = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="tg-worker")
+
+# Updates from the same chat never run concurrently across workers.
+# chat_id -> [lock, users]; an entry lives only while some worker holds or waits on it.
+_chat_locks: Dict[Any, List[Any]] = {}
+_chat_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def _chat_lock(chat_id: Any):
+    with _chat_locks_guard:
+        entry = _chat_locks.get(chat_id)
+        if entry is None:
+            entry = _chat_locks[chat_id] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _chat_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _chat_locks[chat_id]
+
+def _update_chat_id(upd: Dict) -> Any:
+    if "callback_query" in upd:
+        return (((upd["callback_query"] or {}).get("message") or {}).get("chat") or {}).get("id")
+    return ((upd.get("message") or {}).get("chat") or {}).get("id")
+
+def process_update(upd: Dict):
+    # Callback queries
+    if "callback_query" in upd:
+        try:
+            handle_callback(upd["callback_query"])
+        except Exception as e:
+            log.exception("Callback error: %s", e)
         return
 
-    if action == "TOGGLE_SLEEP":
-        newv = not bool(u.get("sleep_enabled"))
-        update_user(chat_id, {"sleep_enabled": newv})
-        tg_answer_callback(cq_id, "✅")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+    # Normal messages
+    if "message" in upd:
+        msg = upd["message"] or {}
+        chat = msg.get("chat") or {}
+        chat_id = chat.get("id")
+        text = msg.get("text", "")
 
-    if action == "TOGGLE_MORNING":
-        newv = not bool(u.get("morning_enabled"))
-        update_user(chat_id, {"morning_enabled": newv})
-        tg_answer_callback(cq_id, "✅")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+        if not chat_id:
+            return
+        if text and len(text) > MAX_TEXT_LEN:
+            tg_send(int(chat_id), f"⚠️ Tin nhắn quá dài (tối đa {MAX_TEXT_LEN} ký tự).")
+            return
 
-    if action == "SHOW_OVERVIEW":
-        tg_answer_callback(cq_id, "📊")
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
+        try:
+            handle_command(int(chat_id), text)
+        except Exception as e:
+            log.exception("Message handle error: %s", e)
+            tg_send(int(chat_id), "⚠️ Có lỗi xảy ra, thử lại giúp mình nhé.")
+
+# Completion watermark for getUpdates: every update_id <= _finished_upto() has
+# run (or been dropped). The poll only confirms, and OFFSET_FILE only saves,
+# up to there, so updates still queued when the process dies come back.
+_inflight_ids: set = set()
+_dispatched_max = 0
+_updates_lock = threading.Lock()
+_update_finished = threading.Event()
+
+def _track_dispatched(update_id: Any, running: bool):
+    global _dispatched_max
+    if not isinstance(update_id, int):
         return
+    with _updates_lock:
+        _dispatched_max = max(_dispatched_max, update_id)
+        if running:
+            _inflight_ids.add(update_id)
 
-    if action == "WATER_MENU":
-        tg_answer_callback(cq_id, "💧")
-        drunk = int(u.get("water_drunk_ml", 0))
-        goal = max(1, int(u.get("water_goal_ml", 2000)))
-        pct = min(100, int(drunk / goal * 100))
-        msg = (
-            "💧 <b>UỐNG NƯỚC HÔM NAY</b>\n\n"
-            f"📊 Tiến độ: <b>{pct}%</b>\n"
-            f"✅ Đã uống: <b>{drunk}ml</b>\n"
-            f"🎯 Mục tiêu: <b>{goal}ml</b>\n\n"
-            "Bấm nút sau khi uống:"
-        )
-        tg_send(chat_id, msg, reply_markup=kb_water())
-        return
+def _finished_upto() -> int:
+    with _updates_lock:
+        return min(_inflight_ids) - 1 if _inflight_ids else _dispatched_max
 
-    if action == "DRANK_250":
-        new_amount = int(u.get("water_drunk_ml", 0)) + 250
-        update_user(chat_id, {"water_drunk_ml": new_amount, "last_water_reminder_ts": int(time.time())})
-        tg_answer_callback(cq_id, "✅ +250ml")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+def _process_update_logged(upd: Dict):
+    """EXECUTOR entry point: exceptions in futures are otherwise silently dropped."""
+    try:
+        with _chat_lock(_update_chat_id(upd)):
+            process_update(upd)
+    except Exception as e:
+        log.exception("Update worker error: %s", e)
+    finally:
+        with _updates_lock:
+            _inflight_ids.discard(upd.get("update_id"))
+        _update_finished.set()
 
-    if action == "DRANK_500":
-        new_amount = int(u.get("water_drunk_ml", 0)) + 500
-        update_user(chat_id, {"water_drunk_ml": new_amount, "last_water_reminder_ts": int(time.time())})
-        tg_answer_callback(cq_id, "✅ +500ml")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+# chat_id -> (tokens, last refill monotonic time)
+_chat_buckets: Dict[Any, Tuple[float, float]] = {}
+_chat_buckets_lock = threading.Lock()
+_buckets_swept_at = 0.0
 
-    if action == "WATER_RESET":
-        update_user(chat_id, {"water_drunk_ml": 0})
-        tg_answer_callback(cq_id, "🔄 Đã reset")
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+def _sweep_rate_state(now: float) -> List[Tuple[Any, int]]:
+    """Forget full buckets and finished log windows. Caller holds _chat_buckets_lock.
 
-    if action == "DATES_MENU":
-        tg_answer_callback(cq_id, "📅")
-        update_user(chat_id, {"pending": None})
-        tg_send(chat_id, "📅 <b>QUẢN LÝ NGÀY</b>\n\nChọn chức năng:", reply_markup=kb_dates())
-        return
+    A full bucket behaves exactly like a missing one, so at most the chats still
+    refilling or dropping stay in memory. Returns unlogged drop counts to report.
+    """
+    global _buckets_swept_at
+    if now - _buckets_swept_at < RATE_LOG_WINDOW_SEC:
+        return []
+    _buckets_swept_at = now
+    for chat_id, (tokens, last) in list(_chat_buckets.items()):
+        if tokens + (now - last) * CHAT_RATE_PER_SEC >= CHAT_RATE_BURST:
+            del _chat_buckets[chat_id]
+    pending = []
+    for chat_id, (dropped, last) in list(_rate_drops.items()):
+        if now - last >= RATE_LOG_WINDOW_SEC:
+            del _rate_drops[chat_id]
+            if dropped:
+                pending.append((chat_id, dropped))
+    return pending
+
+def _take_chat_token(chat_id: Any) -> bool:
+    now = time.monotonic()
+    with _chat_buckets_lock:
+        pending = _sweep_rate_state(now)
+        tokens, last = _chat_buckets.get(chat_id, (CHAT_RATE_BURST, now))
+        tokens = min(CHAT_RATE_BURST, tokens + (now - last) * CHAT_RATE_PER_SEC)
+        allowed = tokens >= 1.0
+        _chat_buckets[chat_id] = (tokens - 1.0 if allowed else tokens, now)
+    for cid, dropped in pending:
+        log.info("ℹ️ Rate limited chat %s: dropped %d update(s)", cid, dropped)
+    return allowed
+
+# chat_id -> (updates dropped since the last log line, time of that line)
+_rate_drops: Dict[Any, Tuple[int, float]] = {}
+
+def _log_rate_limited(chat_id: Any):
+    """Sampled: a flooding chat costs one log line per RATE_LOG_WINDOW_SEC."""
+    now = time.monotonic()
+    with _chat_buckets_lock:
+        dropped, last = _rate_drops.get(chat_id, (0, now - RATE_LOG_WINDOW_SEC))
+        dropped += 1
+        if now - last < RATE_LOG_WINDOW_SEC:
+            _rate_drops[chat_id] = (dropped, last)
+            return
+        _rate_drops[chat_id] = (0, now)
+    log.info("ℹ️ Rate limited chat %s: dropped %d update(s)", chat_id, dropped)
+
+# Recently dispatched update_ids, oldest first
+_seen_updates: "collections.OrderedDict[Any, None]" = collections.OrderedDict()
+_seen_updates_lock = threading.Lock()
+
+def _first_delivery(update_id: Any) -> bool:
+    if update_id is None:
+        return True
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            return False
+        _seen_updates[update_id] = None
+        if len(_seen_updates) > SEEN_UPDATES_MAX:
+            _seen_updates.popitem(last=False)
+        return True
 
-    if action == "VIEW_HOLIDAYS":
-        tg_answer_callback(cq_id, "📅")
-        tg_send(chat_id, build_holidays_message(), reply_markup=kb_dates())
-        return
+def dispatch_update(upd: Dict) -> bool:
+    """Drop redelivered updates, updates without a chat or over the chat's rate; queue the rest.
 
-    if action == "MY_DATES":
-        tg_answer_callback(cq_id, "📋")
-        dates = u.get("important_dates", {}) or {}
-        if not dates:
-            msg = "📋 <b>NGÀY QUAN TRỌNG CỦA BẠN</b>\n\n⚠️ Bạn chưa có ngày nào."
-        else:
-            msg = "📋 <b>NGÀY QUAN TRỌNG CỦA BẠN</b>\n\n"
-            for mm_dd, desc in sorted(dates.items()):
-                msg += f"• <b>{mm_dd}</b>: {desc}\n"
-            msg += "\n\nGợi ý: Muốn sửa, chỉ cần thêm lại đúng <code>MM-DD</code> là sẽ ghi đè."
-        tg_send(chat_id, msg, reply_markup=kb_dates())
-        return
+    Returns False only for a redelivery (already dispatched in this run).
+    """
+    update_id = upd.get("update_id")
+    if not _first_delivery(update_id):
+        return False
+    chat_id = _update_chat_id(upd)
+    if chat_id and _take_chat_token(chat_id):
+        _track_dispatched(update_id, running=True)
+        EXECUTOR.submit(_process_update_logged, upd)
+        return True
+    _track_dispatched(update_id, running=False)
+    if "callback_query" in upd:
+        # Answer anyway, or the button keeps spinning until Telegram times out
+        tg_answer_callback((upd["callback_query"] or {}).get("id", ""))
+    if chat_id:
+        _log_rate_limited(chat_id)
+    return True
 
-    if action == "ADD_DATE":
-        # chuyển sang chế độ nhập (pending)
-        tg_answer_callback(cq_id, "➕")
-        update_user(chat_id, {"pending": {"type": "add_date"}})
-        tg_send(chat_id, build_add_date_prompt(), reply_markup=kb_dates())
-        return
+# Only the update types the handlers read; Telegram then skips the rest
+_ALLOWED_UPDATES = ["message", "callback_query"]
+_POLL_PARAMS = {
+    "timeout": UPDATES_LONGPOLL,
+    "limit": UPDATES_LIMIT,
+    "allowed_updates": json.dumps(_ALLOWED_UPDATES, separators=(",", ":")),
+}
 
-    if action == "BACK":
-        tg_answer_callback(cq_id, "⬅️")
-        update_user(chat_id, {"pending": None})
-        u = ensure_user(chat_id)
-        tg_send(chat_id, build_overview(u), reply_markup=kb_main(u))
-        return
+def setup_webhook() -> bool:
+    d = tg_call("setWebhook", payload={
+        "url": RENDER_EXTERNAL_URL.rstrip("/") + WEBHOOK_PATH,
+        "allowed_updates": _ALLOWED_UPDATES,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "secret_token": WEBHOOK_SECRET,
+    }, read_timeout=15)
+    if not d.get("ok"):
+        log.warning("⚠️ setWebhook failed: %s", d.get("description"))
+        return False
+    log.info("🪝 Webhook mode: updates arrive on %s/webhook/***", RENDER_EXTERNAL_URL.rstrip("/"))
+    return True
 
-    tg_answer_callback(cq_id, "Không hỗ trợ")
+_BOT_ID = TELEGRAM_BOT_TOKEN.partition(":")[0]
+
+def _load_offset() -> int:
+    """Resume after the last finished update before a restart, if the file is recent and ours."""
+    saved = load_json(OFFSET_FILE, {})
+    try:
+        if (
+            isinstance(saved, dict)
+            and saved.get("bot_id") == _BOT_ID
+            and time.time() - float(saved.get("saved_at", 0)) < OFFSET_MAX_AGE_SEC
+        ):
+            return int(saved.get("offset", 0))
+    except Exception:
+        pass
+    if saved:
+        log.info("ℹ️ Ignoring stale or foreign %s", OFFSET_FILE)
+    return 0
+
+_saved_offset = 0
+_offset_saved_at = 0.0
+
+def save_offset(force: bool = False):
+    """Persist the completion watermark, at most once per OFFSET_SAVE_INTERVAL_SEC."""
+    global _saved_offset, _offset_saved_at
+    offset = _finished_upto()
+    now = time.monotonic()
+    if offset == _saved_offset or (not force and now - _offset_saved_at < OFFSET_SAVE_INTERVAL_SEC):
+        return
+    save_json(OFFSET_FILE, {"offset": offset, "bot_id": _BOT_ID, "saved_at": int(time.time())})
+    _saved_offset, _offset_saved_at = offset, now
 
-# ==========================================================
-# UPDATES LOOP
-# ==========================================================
 def handle_updates_forever():
+    global _dispatched_max, _saved_offset
     log.info("📱 Updates handler started")
-    offset = 0
+    with _updates_lock:
+        _dispatched_max = _saved_offset = _load_offset()
 
     # Quick sanity check
     me = tg_call("getMe", read_timeout=15)
@@ -844,62 +1748,110 @@ def handle_updates_forever():
     else:
         log.warning("⚠️ getMe failed: %s", me.get("description"))
 
+    if USE_WEBHOOK:
+        if setup_webhook():
+            return  # KeepAliveHandler.do_POST takes over
+        log.warning("⚠️ Falling back to long polling")
+    # getUpdates is refused while a webhook is registered (e.g. from an earlier run)
+    tg_call("deleteWebhook", read_timeout=15)
+
+    backoff = UPDATES_BACKOFF_MIN
     while not shutdown_event.is_set():
         try:
+            # Offsets confirm updates to Telegram: never past an unfinished one
             d = tg_call(
                 "getUpdates",
-                params={"offset": offset + 1, "timeout": UPDATES_LONGPOLL},
-                read_timeout=UPDATES_LONGPOLL + 15,
+                params={**_POLL_PARAMS, "offset": _finished_upto() + 1},
+                read_timeout=UPDATES_LONGPOLL + 5,
+                http=POLL_HTTP,
             )
 
             if not d.get("ok"):
-                time.sleep(2)
+                retry_after = (d.get("parameters") or {}).get("retry_after")
+                if d.get("error_code") == 429 and retry_after:
+                    # Telegram says exactly how long to back off
+                    delay = float(retry_after)
+                else:
+                    log.warning("⚠️ getUpdates failed: %s", d.get("description"))
+                    delay = random.uniform(0, backoff)
+                    backoff = min(backoff * 2, UPDATES_BACKOFF_MAX)
+                shutdown_event.wait(delay)
                 continue
-
-            for upd in d.get("result", []) or []:
-                offset = upd.get("update_id", offset)
-
-                # Callback queries
-                if "callback_query" in upd:
-                    try:
-                        handle_callback(upd["callback_query"])
-                    except Exception as e:
-                        log.exception("Callback error: %s", e)
-                    continue
-
-                # Normal messages
-                if "message" in upd:
-                    msg = upd["message"] or {}
-                    chat = msg.get("chat") or {}
-                    chat_id = chat.get("id")
-                    text = msg.get("text", "")
-
-                    if not chat_id:
-                        continue
-
-                    try:
-                        handle_command(int(chat_id), text)
-                    except Exception as e:
-                        log.exception("Message handle error: %s", e)
-                        tg_send(int(chat_id), "⚠️ Có lỗi xảy ra, thử lại giúp mình nhé.")
-                    continue
+            backoff = UPDATES_BACKOFF_MIN
+
+            result = d.get("result", []) or []
+            fresh = False
+            for upd in result:
+                fresh = dispatch_update(upd) or fresh
+            if result and not fresh:
+                # Only updates still running came back: wait for one to finish
+                _update_finished.wait(OFFSET_SAVE_INTERVAL_SEC)
+            _update_finished.clear()
+            save_offset()
 
         except Exception as e:
             log.exception("Updates loop error: %s", e)
-            time.sleep(3)
+            shutdown_event.wait(random.uniform(0, backoff))
+            backoff = min(backoff * 2, UPDATES_BACKOFF_MAX)
 
 # ==========================================================
-# FLASK APP (RENDER KEEP-ALIVE)
+# HTTP SERVER (RENDER KEEP-ALIVE)
 # ==========================================================
-app = Flask(__name__)
+_ROUTES = {"/": b"OK", "/ping": b"pong"}
+
+_WEBHOOK_PATH_B = WEBHOOK_PATH.encode("latin-1", "replace")
+_WEBHOOK_SECRET_B = WEBHOOK_SECRET.encode("latin-1", "replace")
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    def _reply(self, with_body: bool):
+        body = _ROUTES.get(self.path.split("?", 1)[0])
+        status = 200 if body is not None else 404
+        body = body if body is not None else b"Not Found"
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(True)
+
+    def do_HEAD(self):
+        self._reply(False)
+
+    def do_POST(self):
+        # Only the webhook accepts POSTs. Compare bytes: compare_digest raises
+        # TypeError on non-ASCII str, and path/headers come from anyone.
+        path_ok = hmac.compare_digest(self.path.encode("latin-1", "replace"), _WEBHOOK_PATH_B)
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        token_ok = hmac.compare_digest(token.encode("latin-1", "replace"), _WEBHOOK_SECRET_B)
+        if not (WEBHOOK_SECRET and path_ok and token_ok):
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if not 0 < length <= WEBHOOK_MAX_BODY:
+            self.send_error(413 if length > 0 else 400)
+            return
+        try:
+            upd = json_loads(self.rfile.read(length))
+        except Exception:
+            self.send_error(400)
+            return
+        # Answer right away; the update runs on the same workers as polled ones
+        if isinstance(upd, dict):
+            dispatch_update(upd)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-@app.get("/")
-def home():
-    return "OK", 200
+    def log_message(self, format, *args):
+        pass  # health checks every few seconds would flood the log
 
-@app.get("/ping")
-def ping():
-    return "pong", 200
+_httpd: Optional[ThreadingHTTPServer] = None
 
 # ==========================================================
 # SHUTDOWN
@@ -907,6 +1859,12 @@ def ping():
 def _handle_signal(sig, frame):
     log.warning("🛑 Signal received (%s) - shutting down...", sig)
     shutdown_event.set()
+    sched_wakeup.set()
+    # No flush here: main()'s finally (and atexit) flush once serve_forever returns.
+    # Flushing from the handler could deadlock on _write_lock if a signal lands mid-flush.
+    if _httpd is not None:
+        # shutdown() blocks until serve_forever returns, so not from this (serving) thread
+        threading.Thread(target=_httpd.shutdown, daemon=True).start()
 
 try:
     signal.signal(signal.SIGINT, _handle_signal)
@@ -918,21 +1876,32 @@ except Exception:
 # MAIN
 # ==========================================================
 def main():
+    global _httpd
     # Start background threads
     t_updates = threading.Thread(target=handle_updates_forever, name="tg-updates", daemon=True)
     t_sched = threading.Thread(target=scheduler_loop, name="scheduler", daemon=True)
+    t_writer = threading.Thread(target=run_users_writer, name="users-writer", daemon=True)
     t_updates.start()
     t_sched.start()
+    t_writer.start()
+    for i in range(SEND_WORKERS):
+        threading.Thread(target=run_sender, name=f"tg-send-{i}", daemon=True).start()
 
     if RENDER_EXTERNAL_URL:
-        t_ping = threading.Thread(target=run_self_pinger, name="self-ping", daemon=True)
-        t_ping.start()
+        log.info("🏓 Self-ping every %ds: %s", SELF_PING_INTERVAL_SEC, RENDER_EXTERNAL_URL)
+    else:
+        log.warning("⚠️ Self-ping disabled (no RENDER_EXTERNAL_URL/RENDER_SERVICE_NAME)")
 
     log.info("🚀 Service starting on port %d", PORT)
     try:
-        app.run(host="0.0.0.0", port=PORT)
+        _httpd = ThreadingHTTPServer(("0.0.0.0", PORT), KeepAliveHandler)
+        _httpd.daemon_threads = True
+        _httpd.serve_forever()
     finally:
         shutdown_event.set()
+        sched_wakeup.set()
+        flush_users()
+        save_offset(force=True)
         log.info("👋 Service stopped")
 
 if __name__ == "__main__":